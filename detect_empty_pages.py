@@ -4,26 +4,239 @@ Empty Page Detection Tool for Transkribus PageXML
 Scans PageXML collections and identifies pages without transcribed text content.
 """
 
-import xml.etree.ElementTree as ET
+from xml.parsers import expat
 from pathlib import Path
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import chain, islice
 import argparse
+import mmap
+import os
+import re
 import sys
-from typing import List, Tuple
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    from lxml import etree as LET
+except ImportError:
+    LET = None
+
+
+PAGE_NS = 'http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15'
+
+# Clark-notation tags, compared directly against parsed element tags
+PAGE_TAG = f'{{{PAGE_NS}}}Page'
+TEXTLINE_TAG = f'{{{PAGE_NS}}}TextLine'
+UNICODE_TAG = f'{{{PAGE_NS}}}Unicode'
+
+# Expat reports qualified names as "namespace localname"
+EXPAT_PAGE = f'{PAGE_NS} Page'
+EXPAT_UNICODE = f'{PAGE_NS} Unicode'
+
+PARSE_ERRORS: Tuple[type, ...] = (expat.ExpatError,)
+
+if LET is not None:
+    PARSE_ERRORS += (LET.XMLSyntaxError,)
+
+# Keep lxml's tree small: no xml:id table, no whitespace-only text nodes, and
+# no entity expansion or network access for the (untrusted) input files.
+# Comments and processing instructions are dropped so that text following them
+# stays in elem.text, matching what the Expat scanner sees.
+LXML_PARSE_OPTIONS = dict(
+    collect_ids=False,
+    remove_blank_text=True,
+    remove_comments=True,
+    remove_pis=True,
+    resolve_entities=False,
+    no_network=True,
+    huge_tree=False,
+)
+
+# An unprefixed Unicode start tag directly followed by a non-whitespace ASCII character.
+# It is only trusted when the file's one and only default namespace declaration is
+# PAGE_NS, so the tag means the same element the parsers look for. A match then proves
+# the page has text and parsing can be skipped; anything else (no match, prefixed tags,
+# other or additional namespaces, CDATA, character references, non-ASCII text) falls
+# through to the XML parser. Non-ASCII lead bytes are excluded because bytes patterns
+# only know ASCII whitespace, while the parsers also treat e.g. no-break or ideographic
+# spaces as blank. Files containing comments always take the parser, so commented-out
+# text is never counted.
+FAST_NONEMPTY = re.compile(rb'<Unicode(?:\s[^>]*)?>\s*[^\s<&\x80-\xff]')
+PAGE_NS_DECLARATIONS = (f'xmlns="{PAGE_NS}"'.encode(), f"xmlns='{PAGE_NS}'".encode())
+
+# Files larger than this are memory-mapped for the fast check instead of read
+MMAP_THRESHOLD = 4096
+
+# Bytes read per call when feeding files to Expat
+READ_CHUNK_SIZE = 64 * 1024
+
+# Reports with more rows than this are written as CSV instead of Excel
+EXCEL_ROW_LIMIT = 5000
+
+# Minimum number of seconds between progress updates
+PROGRESS_INTERVAL = 0.5
+
+# Upper bound on files handed to a worker process at once
+MAX_CHUNK_SIZE = 32
+
+
+def scan_page(xml_path: str) -> Tuple[bool, str, Optional[str]]:
+    """
+    Open a PageXML file once and collect everything needed for the report.
+    Returns (is_empty, image_filename, warning); unreadable files count as not empty.
+    Pages proven non-empty by FAST_NONEMPTY are not parsed, so their image
+    filename is not looked up.
+    Defined at module level so it can be dispatched to worker processes.
+    """
+    xml_name = os.path.basename(xml_path)
+    xml_stem = os.path.splitext(xml_name)[0]
+    
+    try:
+        with open(xml_path, 'rb') as f:
+            if _has_text_fast(f):
+                return False, xml_stem, None
+            f.seek(0)
+            
+            if LET is not None:
+                events = LET.iterparse(f, events=('end',), tag=(PAGE_TAG, TEXTLINE_TAG, UNICODE_TAG),
+                                       **LXML_PARSE_OPTIONS)
+                is_empty, image_filename = _scan_events(events)
+            else:
+                is_empty, image_filename = _scan_expat(f)
+        
+    except PARSE_ERRORS as e:
+        return False, xml_stem, f"  Warning: Could not parse {xml_name}: {e}"
+    except Exception as e:
+        return False, xml_stem, f"  Warning: Error processing {xml_name}: {e}"
+    
+    # Fallback to XML filename if imageFilename not found
+    return is_empty, image_filename or xml_stem, None
+
+
+def _has_text_fast(f) -> bool:
+    """Check the raw bytes of an open file against FAST_NONEMPTY."""
+    if os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            # Some FUSE and network mounts cannot be mapped; reading works everywhere
+            pass
+        else:
+            with buf:
+                return _matches_fast(buf)
+    
+    return _matches_fast(f.read())
+
+
+def _matches_fast(buf) -> bool:
+    """Apply the FAST_NONEMPTY rules to a bytes-like buffer."""
+    if buf.find(b'<!--') != -1:
+        return False
+    
+    # Exactly one default namespace declaration, and it must be PAGE_NS
+    start = buf.find(b'xmlns=')
+    if start == -1 or buf.find(b'xmlns=', start + 1) != -1:
+        return False
+    if buf[start:start + len(PAGE_NS_DECLARATIONS[0])] not in PAGE_NS_DECLARATIONS:
+        return False
+    
+    return FAST_NONEMPTY.search(buf) is not None
+
+
+def _scan_events(events) -> Tuple[bool, str]:
+    """
+    Walk streamed end events of Unicode and Page elements, stopping at the first
+    transcribed text so that only the bytes up to it are ever parsed.
+    TextLine end events are only used to free memory.
+    """
+    image_filename = ''
+    
+    for _, elem in events:
+        if elem.tag == UNICODE_TAG:
+            if elem.text and elem.text.strip():
+                # Found non-empty text, page is not empty
+                return False, image_filename
+        elif elem.tag == PAGE_TAG:
+            # Page closes after all of its text, so this is only reached for empty pages
+            image_filename = elem.get('imageFilename', '')
+        
+        # Drop parsed content, including finished earlier siblings such as
+        # previous TextLines, so memory stays flat on large pages
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    
+    # No Unicode elements, or all were empty
+    return True, image_filename
+
+
+class _TextFound(Exception):
+    """Raised from an Expat handler to abort parsing at the first transcribed text."""
+
+
+def _scan_expat(f) -> Tuple[bool, str]:
+    """
+    Feed the file straight to Expat when lxml is not installed.
+    No element objects are built; the handlers only track whether they are in a Unicode element.
+    """
+    parser = expat.ParserCreate(namespace_separator=' ')
+    # Deliver each run of text in one callback rather than one per line or entity
+    parser.buffer_text = True
+    image_filename = ''
+    
+    def start_element(name, attrs):
+        nonlocal image_filename
+        if name == EXPAT_PAGE:
+            image_filename = attrs.get('imageFilename', '')
+        elif name == EXPAT_UNICODE:
+            parser.CharacterDataHandler = character_data
+    
+    def end_element(name):
+        if name == EXPAT_UNICODE:
+            parser.CharacterDataHandler = None
+    
+    def character_data(data):
+        if not data.isspace():
+            raise _TextFound
+    
+    # The text handler is only installed inside Unicode elements, so the
+    # indentation whitespace between all other elements never reaches Python
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    
+    try:
+        # Feed large chunks ourselves; ParseFile only reads 2 KiB per call
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.Parse(chunk, False)
+        parser.Parse(b'', True)
+    except _TextFound:
+        # Found non-empty text, page is not empty
+        return False, image_filename
+    
+    return True, image_filename
 
 
 class EmptyPageDetector:
     """Detects pages without text content in PageXML collections."""
     
-    def __init__(self, base_path: Path, quiet: bool = False):
+    def __init__(self, base_path: Path, quiet: bool = False, workers: Optional[int] = None):
         self.base_path = Path(base_path)
         self.quiet = quiet
-        self.namespace = {'page': 'http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15'}
-        self.empty_pages: List[Tuple[str, str, str]] = []
+        if workers is not None and workers < 1:
+            raise ValueError(f"workers must be at least 1, got {workers}")
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self._executor: Optional[Executor] = None
+        self._page_files: Dict[Path, List[os.DirEntry]] = {}
+        self.total_empty = 0
+        self._last_progress = 0.0
         
-    def log(self, message: str, end: str = '\n'):
+    def log(self, message: str, end: str = '\n', flush: bool = False):
         """Print message unless in quiet mode."""
         if not self.quiet:
-            print(message, end=end, flush=True)
+            print(message, end=end, flush=flush)
     
     def find_collections(self) -> List[Path]:
         """Discover all collection directories containing page/ subdirectories."""
@@ -32,148 +245,159 @@ class EmptyPageDetector:
         if not self.base_path.exists():
             raise FileNotFoundError(f"Base path does not exist: {self.base_path}")
         
-        for item in sorted(self.base_path.iterdir()):
-            if item.is_dir():
-                page_dir = item / 'page'
-                if page_dir.exists() and page_dir.is_dir():
-                    xml_files = list(page_dir.glob('*.xml'))
-                    if xml_files:
-                        collections.append(item)
+        # One directory read per level; DirEntry caches the file type from it
+        with os.scandir(self.base_path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            try:
+                xml_files = self._list_page_files(os.path.join(entry.path, 'page'))
+            except OSError:
+                # Missing, not a directory, or unreadable: not a usable collection
+                continue
+            if xml_files:
+                collection = Path(entry.path)
+                # Keep the listing so process_collection does not read the directory again
+                self._page_files[collection] = xml_files
+                collections.append(collection)
         
         return collections
     
-    def is_page_empty(self, xml_path: Path) -> bool:
+    @staticmethod
+    def _list_page_files(page_dir) -> List[os.DirEntry]:
+        """List the XML files in a page/ directory, sorted by filename."""
+        with os.scandir(page_dir) as it:
+            return sorted((entry for entry in it if entry.name.endswith('.xml') and entry.is_file()),
+                          key=lambda entry: entry.name)
+    
+    def _map(self, func: Callable, items: List[str]) -> Iterator:
+        """Apply func to items in order, using the worker pool when one is running."""
+        if self._executor is None:
+            return map(func, items)
+        
+        # Large enough to amortise pickling, small enough to keep all workers busy
+        chunksize = max(1, min(MAX_CHUNK_SIZE, len(items) // (self.workers * 4)))
+        return self._executor.map(func, items, chunksize=chunksize)
+    
+    def _iter_empty(self, xml_entries: List[os.DirEntry]) -> Iterator[Tuple[str, str]]:
         """
-        Check if a PageXML file contains any transcribed text.
-        Returns True if the page has no text content.
+        Scan each file in a single pass and yield (image filename, XML filename)
+        for the empty pages, reporting progress and warnings along the way.
         """
-        try:
-            tree = ET.parse(xml_path)
-            root = tree.getroot()
-            
-            # Find all TextLine elements
-            text_lines = root.findall('.//page:TextLine', self.namespace)
-            
-            if not text_lines:
-                # No text lines at all means empty page
-                return True
-            
-            # Check if any TextLine contains non-empty Unicode text
-            for text_line in text_lines:
-                unicode_elem = text_line.find('.//page:Unicode', self.namespace)
-                if unicode_elem is not None and unicode_elem.text:
-                    text_content = unicode_elem.text.strip()
-                    if text_content:
-                        # Found non-empty text, page is not empty
-                        return False
-            
-            # All TextLines were empty or had no Unicode elements
-            return True
-            
-        except ET.ParseError as e:
-            self.log(f"  Warning: Could not parse {xml_path.name}: {e}")
-            return False
-        except Exception as e:
-            self.log(f"  Warning: Error processing {xml_path.name}: {e}")
-            return False
-    
-    def get_image_filename(self, xml_path: Path) -> str:
-        """Extract the image filename from PageXML metadata."""
-        try:
-            tree = ET.parse(xml_path)
-            root = tree.getroot()
-            page_elem = root.find('.//page:Page', self.namespace)
-            
-            if page_elem is not None:
-                image_filename = page_elem.get('imageFilename')
-                if image_filename:
-                    return image_filename
-            
-            # Fallback to XML filename if imageFilename not found
-            return xml_path.stem
+        # Plain strings from the cached DirEntry objects, no Path objects per file
+        results = self._map(scan_page, [entry.path for entry in xml_entries])
+        
+        for i, (entry, result) in enumerate(zip(xml_entries, results), 1):
+            if not self.quiet:
+                # Throttle by time so fast scans do not spend their time writing progress
+                now = time.monotonic()
+                if now - self._last_progress >= PROGRESS_INTERVAL:
+                    self.log(f"    Processed {i}/{len(xml_entries)} files", end='\r', flush=True)
+                    self._last_progress = now
             
-        except Exception:
-            return xml_path.stem
-    
-    def process_collection(self, collection_path: Path):
-        """Process all PageXML files in a collection."""
-        collection_name = collection_path.name
-        page_dir = collection_path / 'page'
-        xml_files = sorted(page_dir.glob('*.xml'))
+            is_empty, image_filename, warning = result
+            if warning:
+                self.log(warning)
+            if is_empty:
+                yield image_filename, entry.name
+    
+    def process_collection(self, collection_path: Path) -> Iterator[Tuple[str, str, str]]:
+        """
+        Process all PageXML files in a collection, yielding
+        (collection, image filename, XML filename) for each empty page.
+        """
+        # Interned so every row of a collection shares one string object
+        collection_name = sys.intern(collection_path.name)
+        xml_entries = self._page_files.pop(collection_path, None)
+        if xml_entries is None:
+            xml_entries = self._list_page_files(collection_path / 'page')
         
         self.log(f"\n  Processing collection: {collection_name}")
-        self.log(f"  Found {len(xml_files)} XML files")
+        self.log(f"  Found {len(xml_entries)} XML files")
         
         empty_count = 0
-        for i, xml_file in enumerate(xml_files, 1):
-            if not self.quiet and i % 10 == 0:
-                self.log(f"    Processed {i}/{len(xml_files)} files", end='\r')
-            
-            if self.is_page_empty(xml_file):
-                image_filename = self.get_image_filename(xml_file)
-                self.empty_pages.append((collection_name, image_filename, xml_file.name))
-                empty_count += 1
+        for image_filename, xml_name in self._iter_empty(xml_entries):
+            empty_count += 1
+            self.total_empty += 1
+            yield collection_name, image_filename, xml_name
         
-        if not self.quiet:
-            self.log(f"    Processed {len(xml_files)}/{len(xml_files)} files    ")
-        self.log(f"  Found {empty_count} empty page(s) in {collection_name}")
+        self.log(f"    Processed {len(xml_entries)}/{len(xml_entries)} files    ")
+        self.log(f"  Found {empty_count} empty page(s) in {collection_name}", flush=True)
     
-    def run(self) -> List[Tuple[str, str, str]]:
-        """Execute the empty page detection process."""
+    def iter_empty(self) -> Iterator[Tuple[str, str, str]]:
+        """
+        Execute the empty page detection process, yielding
+        (collection, image filename, XML filename) as soon as each empty page is found.
+        """
         self.log("=== Empty Page Detection Tool ===\n")
+        self.total_empty = 0
         
         collections = self.find_collections()
         
         if not collections:
             self.log("No collections found. Please check the directory structure.")
-            self.log("Expected structure: base_path/Collection_Name/page/*.xml")
-            return []
+            self.log("Expected structure: base_path/Collection_Name/page/*.xml", flush=True)
+            return
         
         self.log(f"Found {len(collections)} collection(s):")
         for collection in collections:
             self.log(f"  - {collection.name}")
         
-        for collection in collections:
-            self.process_collection(collection)
+        # Files are independent, so parse them on all available cores
+        if self.workers > 1:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            for collection in collections:
+                yield from self.process_collection(collection)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
         
         self.log(f"\n=== Summary ===")
-        self.log(f"Total empty pages found: {len(self.empty_pages)}")
-        self.log(f"Collections processed: {len(collections)}")
-        
-        return self.empty_pages
+        self.log(f"Total empty pages found: {self.total_empty}")
+        self.log(f"Collections processed: {len(collections)}", flush=True)
+    
+    def run(self) -> List[Tuple[str, str, str]]:
+        """Execute the empty page detection process and collect all results."""
+        return list(self.iter_empty())
 
 
-def write_to_excel(empty_pages: List[Tuple[str, str, str]], output_path: Path):
+def write_to_excel(empty_pages: Iterable[Tuple[str, str, str]], output_path: Path):
     """Write empty pages data to Excel file using openpyxl."""
     try:
         from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
         from openpyxl.styles import Font, Alignment, PatternFill
         
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Empty Pages"
+        # Write-only mode streams rows to disk instead of keeping every cell in memory
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Empty Pages")
         
-        # Create header row
-        headers = ['Collection', 'Image Filename', 'XML Filename']
-        ws.append(headers)
+        # Column widths must be set before the first row is written
+        ws.column_dimensions['A'].width = 25
+        ws.column_dimensions['B'].width = 50
+        ws.column_dimensions['C'].width = 50
         
-        # Style header row
+        # Create styled header row
         header_fill = PatternFill(start_color='366092', end_color='366092', fill_type='solid')
         header_font = Font(bold=True, color='FFFFFF')
+        header_alignment = Alignment(horizontal='center', vertical='center')
         
-        for cell in ws[1]:
+        headers = []
+        for title in ['Collection', 'Image Filename', 'XML Filename']:
+            cell = WriteOnlyCell(ws, value=title)
             cell.fill = header_fill
             cell.font = header_font
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-        
-        # Add data rows
-        for collection, image_filename, xml_filename in empty_pages:
-            ws.append([collection, image_filename, xml_filename])
+            cell.alignment = header_alignment
+            headers.append(cell)
+        ws.append(headers)
         
-        # Adjust column widths
-        ws.column_dimensions['A'].width = 25
-        ws.column_dimensions['B'].width = 50
-        ws.column_dimensions['C'].width = 50
+        # Add data rows as plain values, no cell objects needed
+        for row in empty_pages:
+            ws.append(row)
         
         # Save workbook
         wb.save(output_path)
@@ -183,22 +407,44 @@ def write_to_excel(empty_pages: List[Tuple[str, str, str]], output_path: Path):
         return False
 
 
-def write_to_csv_fallback(empty_pages: List[Tuple[str, str, str]], output_path: Path):
-    """Fallback: Write to CSV if openpyxl is not available."""
+def write_to_csv(empty_pages: Iterable[Tuple[str, str, str]], output_path: Path):
+    """Write empty pages data to CSV, for large reports or if openpyxl is not available."""
     import csv
     
     csv_path = output_path.with_suffix('.csv')
+    # Rows may still be produced by a running scan; write under a temporary name
+    # so a failed or interrupted run never leaves a truncated report behind
+    partial_path = csv_path.with_name(csv_path.name + '.partial')
     
-    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(['Collection', 'Image Filename', 'XML Filename'])
-        writer.writerows(empty_pages)
+    try:
+        with open(partial_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, dialect='excel')
+            writer.writerow(['Collection', 'Image Filename', 'XML Filename'])
+            writer.writerows(empty_pages)
+    except BaseException:
+        try:
+            os.remove(partial_path)
+        except OSError:
+            pass
+        raise
     
+    os.replace(partial_path, csv_path)
     return csv_path
 
 
-def main():
-    """Main execution function."""
+def positive_int(value: str) -> int:
+    """Argparse type for options that need a whole number of at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    """Build the command-line interface."""
     parser = argparse.ArgumentParser(
         description='Detect pages without transcribed text in Transkribus PageXML collections',
         formatter_class=argparse.RawDescriptionHelpFormatter
@@ -222,7 +468,24 @@ def main():
         help='Suppress progress output'
     )
     
-    args = parser.parse_args()
+    parser.add_argument(
+        '-j', '--workers',
+        type=positive_int,
+        help='Number of worker processes (default: number of CPUs, 1 disables parallelism)',
+        default=None
+    )
+    
+    return parser
+
+
+# Resolved once at import rather than on every call to main()
+SCRIPT_DIR = Path(__file__).parent.resolve()
+ARG_PARSER = build_arg_parser()
+
+
+def main(argv: Optional[List[str]] = None):
+    """Main execution function."""
+    args = ARG_PARSER.parse_args(argv)
     
     # Get base path from argument or prompt
     if args.base_path:
@@ -239,22 +502,35 @@ def main():
         output_path = Path(args.output)
     else:
         # Default: place in script directory
-        script_dir = Path(__file__).parent.resolve()
-        output_path = script_dir / 'empty_pages.xlsx'
+        output_path = SCRIPT_DIR / 'empty_pages.xlsx'
     
     try:
         # Run detection
-        detector = EmptyPageDetector(base_path, args.quiet)
-        empty_pages = detector.run()
+        detector = EmptyPageDetector(base_path, args.quiet, args.workers)
+        empty_pages = detector.iter_empty()
+        
+        # Buffer at most EXCEL_ROW_LIMIT + 1 rows to choose the output format
+        first_pages = list(islice(empty_pages, EXCEL_ROW_LIMIT + 1))
         
-        if not empty_pages:
+        if not first_pages:
             print("\n✓ No empty pages found. All pages contain transcribed text.")
             return
         
+        if len(first_pages) > EXCEL_ROW_LIMIT:
+            # Formatting is of little use at this size and CSV is far faster to write;
+            # remaining pages are detected while the file is being written, so say so
+            # before the rest of the scan output appears
+            print(f"\nNote: more than {EXCEL_ROW_LIMIT} empty pages, "
+                  f"creating CSV instead while the scan continues")
+            csv_path = write_to_csv(chain(first_pages, empty_pages), output_path)
+            print(f"\n✓ Report generated: {csv_path}")
+            print(f"  Open the file in Excel or a text editor to view the results")
+            return
+        
         # Write output
         print(f"\nGenerating output file...")
         
-        excel_success = write_to_excel(empty_pages, output_path)
+        excel_success = write_to_excel(first_pages, output_path)
         
         if excel_success:
             print(f"✓ Report generated: {output_path}")
@@ -262,7 +538,7 @@ def main():
         else:
             # Fallback to CSV
             print("Note: openpyxl not available, creating CSV instead")
-            csv_path = write_to_csv_fallback(empty_pages, output_path)
+            csv_path = write_to_csv(first_pages, output_path)
             print(f"✓ Report generated: {csv_path}")
             print(f"  Open the file in Excel or a text editor to view the results")
             print(f"\nTo enable Excel output, install openpyxl:")